@@ -1,11 +1,28 @@
 # app.py
-from flask import Flask, jsonify, abort, send_file, Response
+# Patch blocking I/O before anything else is imported so psycopg yields to
+# other greenlets (gunicorn -k gevent). Only psycopg >= 3.1.14 detects the
+# patched selectors; older builds wait in C and block the whole hub.
+import gevent
+from gevent import monkey
+monkey.patch_all()
+
+from flask import Flask, jsonify, abort, send_file, Response, stream_with_context
+from flask_caching import Cache
 import os
-import json
-from sqlalchemy import create_engine, text
-from collections import OrderedDict
+import logging
+import orjson
+from functools import lru_cache
+from sqlalchemy import create_engine, text, bindparam, Float
+from sqlalchemy.pool import QueuePool
+
+logger = logging.getLogger(__name__)
 
 _engine = None
+cache = Cache()
+
+# Must match the SRID create_db.py stored ns.coordinates.geom with (--srid);
+# ST_3DIntersects rejects mixed-SRID arguments.
+COORD_SRID = int(os.getenv("COORD_SRID", "4326"))
 
 def get_engine():
     global _engine
@@ -14,15 +31,55 @@ def get_engine():
     db_url = os.getenv("DB_URL")
     if not db_url:
         raise RuntimeError("Missing DB_URL environment variable.")
-    # Normalize old 'postgres://' scheme to 'postgresql://'
-    if db_url.startswith("postgres://"):
-        db_url = "postgresql://" + db_url[len("postgres://"):]
+    # Normalize 'postgres://' / bare 'postgresql://' to the psycopg 3 driver
+    for scheme in ("postgres://", "postgresql://"):
+        if db_url.startswith(scheme):
+            db_url = "postgresql+psycopg://" + db_url[len(scheme):]
+            break
+    # Every route is a single DB round-trip, so pool sizing dominates throughput.
+    # Pre-ping is off (it costs a SELECT 1 per checkout); a short recycle
+    # (DB_POOL_RECYCLE) instead keeps connections fresh behind PgBouncer.
+    # Recycling also drops the warm-up's connections and each connection's
+    # server-side prepared statements, so raise it when nothing in front of
+    # Postgres closes idle connections. search_path is set once per
+    # connection at startup rather than per request.
+    # Under gevent one worker serves many greenlets at once; size
+    # DB_POOL_SIZE + DB_MAX_OVERFLOW to the in-flight queries expected per
+    # worker, or greenlets queue on pool_timeout instead of on Postgres.
     _engine = create_engine(
         db_url,
-        pool_pre_ping=True
+        poolclass=QueuePool,
+        pool_size=int(os.getenv("DB_POOL_SIZE", "10")),
+        max_overflow=int(os.getenv("DB_MAX_OVERFLOW", "20")),
+        pool_timeout=30,
+        pool_recycle=int(os.getenv("DB_POOL_RECYCLE", "60")),
+        pool_pre_ping=False,
+        future=True,
+        # psycopg 3 server-side prepares a statement after prepare_threshold
+        # executions, so the hot route queries skip parse/plan after warm-up.
+        connect_args={"options": "-c search_path=ns,public", "prepare_threshold": 5},
     )
     return _engine
 
+def warm_pool(eng):
+    # Hold pool_size connections at once so each one really opens, then hand
+    # them all back; the first requests after a deploy skip the handshake.
+    # A warmed connection is replaced on its first checkout after
+    # DB_POOL_RECYCLE seconds, so this only covers that window after startup.
+    # Failures (DB down or slow) are logged, never raised.
+    conns = []
+    try:
+        for _ in range(eng.pool.size()):
+            conn = eng.connect()
+            conns.append(conn)
+            conn.execute(text("SELECT 1"))
+    except Exception as e:
+        logger.warning("DB pool warm-up failed: %s", e)
+    finally:
+        for conn in conns:
+            conn.close()
+
+@lru_cache(maxsize=4096)
 def normalize_term(term: str) -> str:
     prefix = "terms_abstract_tfidf__"
     term = term.strip().lower()
@@ -30,8 +87,178 @@ def normalize_term(term: str) -> str:
         term = prefix + term
     return term
 
+# MNI space fits comfortably inside +/-100 mm on every axis
+MNI_MIN, MNI_MAX = -100, 100
+
+@lru_cache(maxsize=1024)
+def parse_coord(coord: str) -> tuple[int, int, int]:
+    # Reject oversized input before int() has to chew through it
+    if len(coord) > 32:
+        raise ValueError("coordinate string too long")
+    x, y, z = map(int, coord.split("_"))
+    if not all(MNI_MIN <= v <= MNI_MAX for v in (x, y, z)):
+        raise ValueError("coordinate out of MNI range")
+    return x, y, z
+
+# Upper bound on the /terms_sample body kept in memory while streaming so a
+# miss can fill the cache without a second query.
+TERMS_SAMPLE_CACHE_MAX_BYTES = 8 * 1024 * 1024
+
+def _terms_sample_chunks(first, parts):
+    yield b"[" + b",".join(orjson.dumps(t) for t in first)
+    for part in parts:
+        yield b"," + b",".join(orjson.dumps(t) for t in part)
+    yield b"]"
+
+def _cache_config():
+    redis_url = os.getenv("REDIS_URL")
+    # Fall back to a per-process cache when no Redis is configured (local dev)
+    if not redis_url:
+        return {"CACHE_TYPE": "SimpleCache", "CACHE_DEFAULT_TIMEOUT": 3600}
+    return {
+        "CACHE_TYPE": "RedisCache",
+        "CACHE_REDIS_URL": redis_url,
+        "CACHE_DEFAULT_TIMEOUT": 3600,
+    }
+
+def _is_ok(rv) -> bool:
+    # Only cache successful responses; handlers return (body, status) on error
+    status = rv[1] if isinstance(rv, tuple) else getattr(rv, "status_code", 200)
+    return status == 200
+
+def _studies_cache_key(term):
+    return f"studies_by_term:{normalize_term(term)}"
+
+# Statements are built once at import and reused by every request.
+# ns.term_studies (built by create_db.py) holds one row per term with its
+# distinct study_ids, so term routes read one index entry per term instead of
+# every matching annotations_terms row.
+_Q_TERMS_SAMPLE = text("SELECT term FROM ns.term_studies LIMIT 100000")
+
+# Response bodies are assembled by Postgres with json_agg/json_build_object and
+# passed through as text (psycopg would otherwise decode json into Python
+# objects), so handlers never build per-row dicts or re-encode them.
+_Q_STUDIES_BY_TERM = text("""
+    SELECT coalesce(json_agg(json_build_object('study_id', r.study_id, 'title', r.title)), '[]')::text
+    FROM (
+        SELECT DISTINCT m.study_id, m.title
+        FROM ns.term_studies t
+        CROSS JOIN LATERAL unnest(t.sids) AS s(study_id)
+        JOIN ns.metadata m ON m.study_id = s.study_id
+        WHERE t.term = :term
+        LIMIT 10000
+    ) r;
+""")
+
+# One round-trip: each term's study set is read once from term_studies, then
+# diffed both ways with EXCEPT.
+_Q_DISSOCIATE_TERMS = text("""
+    WITH a AS (
+        SELECT unnest(sids) AS study_id FROM ns.term_studies WHERE term = :term_a
+    ),
+    b AS (
+        SELECT unnest(sids) AS study_id FROM ns.term_studies WHERE term = :term_b
+    ),
+    a_only AS (
+        SELECT DISTINCT m.study_id, m.title
+        FROM (SELECT study_id FROM a EXCEPT SELECT study_id FROM b) x
+        JOIN ns.metadata m USING (study_id)
+        LIMIT 1000
+    ),
+    b_only AS (
+        SELECT DISTINCT m.study_id, m.title
+        FROM (SELECT study_id FROM b EXCEPT SELECT study_id FROM a) x
+        JOIN ns.metadata m USING (study_id)
+        LIMIT 1000
+    )
+    SELECT json_build_object(
+        'term_a', CAST(:term_a_display AS text),
+        'term_b', CAST(:term_b_display AS text),
+        'term_a_not_term_b', (
+            SELECT coalesce(json_agg(json_build_object('study_id', study_id, 'title', title)), '[]')
+            FROM a_only
+        ),
+        'term_b_not_term_a', (
+            SELECT coalesce(json_agg(json_build_object('study_id', study_id, 'title', title)), '[]')
+            FROM b_only
+        )
+    )::text;
+""")
+
+# Intersect the two study-id sets before touching metadata; a self-join on
+# annotations_terms multiplied rows per study before DISTINCT collapsed them.
+# study_id is TEXT, so intarray's & doesn't apply; INTERSECT the unnested sets.
+_Q_INTERSECT_TERMS = text("""
+    WITH both_terms AS (
+        SELECT DISTINCT m.study_id, m.title
+        FROM ns.metadata m
+        WHERE m.study_id IN (
+            SELECT unnest(sids) FROM ns.term_studies WHERE term = :term_a
+            INTERSECT
+            SELECT unnest(sids) FROM ns.term_studies WHERE term = :term_b
+        )
+        LIMIT 100
+    )
+    SELECT json_build_object(
+        'term_a', CAST(:term_a_display AS text),
+        'term_b', CAST(:term_b_display AS text),
+        'term_a_and_term_b', (
+            SELECT coalesce(json_agg(json_build_object('study_id', study_id, 'title', title)), '[]')
+            FROM both_terms
+        )
+    )::text;
+""")
+
+# ST_3DIntersects against a constant point lets the N-D GiST index on geom
+# prune candidates; ST_X/Y/Z equality forced a full scan.
+_COORD_BINDS = [bindparam(n, type_=Float) for n in ("x1", "y1", "z1", "x2", "y2", "z2")]
+
+# Same shape as _Q_DISSOCIATE_TERMS: each point's study set is one index
+# probe, diffed both ways in a single round-trip.
+_Q_DISSOCIATE_COORDS = text("""
+    WITH s1 AS (
+        SELECT study_id FROM ns.coordinates
+        WHERE ST_3DIntersects(geom, ST_SetSRID(ST_MakePoint(:x1, :y1, :z1), :srid))
+    ),
+    s2 AS (
+        SELECT study_id FROM ns.coordinates
+        WHERE ST_3DIntersects(geom, ST_SetSRID(ST_MakePoint(:x2, :y2, :z2), :srid))
+    ),
+    only_1 AS (
+        SELECT DISTINCT m.study_id, m.title
+        FROM (SELECT study_id FROM s1 EXCEPT SELECT study_id FROM s2) x
+        JOIN ns.metadata m USING (study_id)
+        LIMIT 100
+    ),
+    only_2 AS (
+        SELECT DISTINCT m.study_id, m.title
+        FROM (SELECT study_id FROM s2 EXCEPT SELECT study_id FROM s1) x
+        JOIN ns.metadata m USING (study_id)
+        LIMIT 100
+    )
+    SELECT json_build_object(
+        'coordinate_1', CAST(:coord1_display AS text),
+        'coordinate_2', CAST(:coord2_display AS text),
+        'coordinate_1_not_coordinate_2', (
+            SELECT coalesce(json_agg(json_build_object('study_id', study_id, 'title', title)), '[]')
+            FROM only_1
+        ),
+        'coordinate_2_not_coordinate_1', (
+            SELECT coalesce(json_agg(json_build_object('study_id', study_id, 'title', title)), '[]')
+            FROM only_2
+        )
+    )::text;
+""").bindparams(*_COORD_BINDS)
+
 def create_app():
     app = Flask(__name__)
+    cache.init_app(app, config=_cache_config())
+
+    # Runs once per gunicorn worker on import; don't combine with --preload,
+    # or forked workers would share the parent's sockets. It runs on its own
+    # greenlet so a slow or unreachable database can't stall worker boot.
+    if os.getenv("DB_URL"):
+        gevent.spawn(warm_pool, get_engine())
 
     @app.get("/", endpoint="health")
     def health():
@@ -43,8 +270,7 @@ def create_app():
         payload = {"ok": False, "dialect": eng.dialect.name}
 
         try:
-            with eng.begin() as conn:
-                conn.execute(text("SET search_path TO ns, public;"))
+            with eng.connect().execution_options(isolation_level="AUTOCOMMIT") as conn:
                 payload["version"] = conn.exec_driver_sql("SELECT version()").scalar()
                 payload["coordinates_count"] = conn.execute(text("SELECT COUNT(*) FROM ns.coordinates")).scalar()
                 payload["metadata_count"] = conn.execute(text("SELECT COUNT(*) FROM ns.metadata")).scalar()
@@ -71,25 +297,53 @@ def create_app():
 
     @app.get("/terms_sample")
     def get_terms_sample():
-        eng = get_engine()
-        with eng.begin() as conn:
-            rows = conn.execute(text("SELECT DISTINCT term FROM ns.annotations_terms LIMIT 100000")).fetchall()
-            return jsonify([r[0] for r in rows])
+        body = cache.get("terms_sample")
+        if body is not None:
+            return Response(body, mimetype="application/json")
+
+        # Connect, execute and fetch the first partition before returning, so
+        # DB failures still surface as a 500 rather than a truncated 200.
+        # Server-side cursors (DECLARE without HOLD) need a transaction, so
+        # this route keeps the default (non-autocommit) connection.
+        conn = get_engine().connect()
+        try:
+            result = conn.execution_options(yield_per=1000).execute(_Q_TERMS_SAMPLE)
+            parts = result.scalars().partitions()
+            first = next(parts, [])
+        except Exception:
+            conn.close()
+            raise
+
+        def generate():
+            # Keep streamed chunks for the cache only up to a fixed budget;
+            # past it the body is served but not cached.
+            kept, size = [], 0
+            for chunk in _terms_sample_chunks(first, parts):
+                if kept is not None:
+                    size += len(chunk)
+                    if size <= TERMS_SAMPLE_CACHE_MAX_BYTES:
+                        kept.append(chunk)
+                    else:
+                        kept = None
+                yield chunk
+            if kept is not None:
+                cache.set("terms_sample", b"".join(kept), timeout=86400)
+
+        resp = Response(stream_with_context(generate()), mimetype="application/json")
+        # Werkzeug calls this even when the body is never iterated (HEAD,
+        # client gone before the first chunk), so the connection can't leak.
+        resp.call_on_close(conn.close)
+        return resp
 
     @app.get("/terms/<term>/studies")
+    @cache.cached(timeout=3600, make_cache_key=_studies_cache_key, response_filter=_is_ok)
     def get_studies_by_term(term):
         eng = get_engine()
         term = normalize_term(term)
         try:
-            with eng.begin() as conn:
-                rows = conn.execute(text("""
-                    SELECT DISTINCT s.study_id, m.title
-                    FROM ns.annotations_terms s
-                    JOIN ns.metadata m USING (study_id)
-                    WHERE s.term = :term
-                    LIMIT 10000;
-            """), {"term": term}).mappings().all()
-            return jsonify([dict(r) for r in rows])
+            with eng.connect().execution_options(isolation_level="AUTOCOMMIT") as conn:
+                body = conn.execute(_Q_STUDIES_BY_TERM, {"term": term}).scalar()
+            return Response(body, mimetype="application/json")
         except Exception as e:
             return jsonify({"error": str(e)}), 500
 
@@ -104,40 +358,13 @@ def create_app():
         term_b_db = normalize_term(term_b_display)
 
         try:
-            with eng.begin() as conn:
-                rows_a = conn.execute(text("""
-                    SELECT DISTINCT m.study_id, m.title
-                    FROM ns.annotations_terms a
-                    JOIN ns.metadata m ON a.study_id = m.study_id
-                    WHERE a.term = :term_a
-                    AND NOT EXISTS (
-                        SELECT 1 FROM ns.annotations_terms b
-                        WHERE b.study_id = a.study_id AND b.term = :term_b
-                    )
-                    LIMIT 1000;
-                """), {"term_a": term_a_db, "term_b": term_b_db}).mappings().all()
-
-                rows_b = conn.execute(text("""
-                    SELECT DISTINCT m.study_id, m.title
-                    FROM ns.annotations_terms b
-                    JOIN ns.metadata m ON b.study_id = m.study_id
-                    WHERE b.term = :term_b
-                    AND NOT EXISTS (
-                        SELECT 1 FROM ns.annotations_terms a
-                        WHERE a.study_id = b.study_id AND a.term = :term_a
-                    )
-                    LIMIT 1000;
-                """), {"term_a": term_a_db, "term_b": term_b_db}).mappings().all()
-
-            return Response(
-                json.dumps(OrderedDict([
-                    ("term_a", term_a_display),
-                    ("term_b", term_b_display),
-                    ("term_a_not_term_b", [dict(r) for r in rows_a]),
-                    ("term_b_not_term_a", [dict(r) for r in rows_b]),
-                ])),
-                mimetype="application/json"
-            )
+            with eng.connect().execution_options(isolation_level="AUTOCOMMIT") as conn:
+                body = conn.execute(_Q_DISSOCIATE_TERMS, {
+                    "term_a": term_a_db, "term_b": term_b_db,
+                    "term_a_display": term_a_display, "term_b_display": term_b_display,
+                }).scalar()
+
+            return Response(body, mimetype="application/json")
 
         except Exception as e:
             return jsonify({"error": str(e)}), 500
@@ -153,25 +380,13 @@ def create_app():
         term_b_db = normalize_term(term_b_display)
 
         try:
-            with eng.begin() as conn:
-                rows = conn.execute(text("""
-                    SELECT DISTINCT m.study_id, m.title
-                    FROM ns.annotations_terms a
-                    JOIN ns.annotations_terms b ON a.study_id = b.study_id
-                    JOIN ns.metadata m ON a.study_id = m.study_id
-                    WHERE a.term = :term_a
-                        AND b.term = :term_b
-                    LIMIT 100;
-                """), {"term_a": term_a_db, "term_b": term_b_db}).mappings().all()
-
-            return Response(
-                json.dumps(OrderedDict([
-                    ("term_a", term_a_display),
-                    ("term_b", term_b_display),
-                    ("term_a_and_term_b", [dict(r) for r in rows]),
-                ])),
-                mimetype="application/json"
-            )
+            with eng.connect().execution_options(isolation_level="AUTOCOMMIT") as conn:
+                body = conn.execute(_Q_INTERSECT_TERMS, {
+                    "term_a": term_a_db, "term_b": term_b_db,
+                    "term_a_display": term_a_display, "term_b_display": term_b_display,
+                }).scalar()
+
+            return Response(body, mimetype="application/json")
 
         except Exception as e:
             return jsonify({"error": str(e)}), 500
@@ -181,54 +396,26 @@ def create_app():
         eng = get_engine()
 
         try:
-            x1, y1, z1 = map(int, coord1.split("_"))
-            x2, y2, z2 = map(int, coord2.split("_"))
+            x1, y1, z1 = parse_coord(coord1)
+            x2, y2, z2 = parse_coord(coord2)
         except ValueError:
-            return jsonify({"error": "Coordinates must be in x_y_z format and integers."}), 400
+            return jsonify({
+                "error": f"Coordinates must be in x_y_z format and integers between {MNI_MIN} and {MNI_MAX}."
+            }), 400
+
+        params = {
+            "x1": x1, "y1": y1, "z1": z1,
+            "x2": x2, "y2": y2, "z2": z2,
+            "srid": COORD_SRID,
+            "coord1_display": f"{x1},{y1},{z1}",
+            "coord2_display": f"{x2},{y2},{z2}",
+        }
 
         try:
-            with eng.begin() as conn:
-                rows_1_not_2 = conn.execute(text("""
-                    SELECT DISTINCT m.study_id, m.title
-                    FROM ns.coordinates c1
-                    JOIN ns.metadata m ON c1.study_id = m.study_id
-                    WHERE ST_X(c1.geom) = :x1 AND ST_Y(c1.geom) = :y1 AND ST_Z(c1.geom) = :z1
-                    AND NOT EXISTS (
-                        SELECT 1 FROM ns.coordinates c2
-                        WHERE c2.study_id = c1.study_id
-                        AND ST_X(c2.geom) = :x2 AND ST_Y(c2.geom) = :y2 AND ST_Z(c2.geom) = :z2
-                    )
-                    LIMIT 100;
-                """), {
-                    "x1": x1, "y1": y1, "z1": z1,
-                    "x2": x2, "y2": y2, "z2": z2
-                }).mappings().all()
-
-                rows_2_not_1 = conn.execute(text("""
-                    SELECT DISTINCT m.study_id, m.title
-                    FROM ns.coordinates c2
-                    JOIN ns.metadata m ON c2.study_id = m.study_id
-                    WHERE ST_X(c2.geom) = :x2 AND ST_Y(c2.geom) = :y2 AND ST_Z(c2.geom) = :z2
-                    AND NOT EXISTS (
-                        SELECT 1 FROM ns.coordinates c1
-                        WHERE c1.study_id = c2.study_id
-                        AND ST_X(c1.geom) = :x1 AND ST_Y(c1.geom) = :y1 AND ST_Z(c1.geom) = :z1
-                    )
-                    LIMIT 100;
-                """), {
-                    "x1": x1, "y1": y1, "z1": z1,
-                    "x2": x2, "y2": y2, "z2": z2
-                }).mappings().all()
-
-            return Response(
-                json.dumps(OrderedDict([
-                    ("coordinate_1", f"{x1},{y1},{z1}"),
-                    ("coordinate_2", f"{x2},{y2},{z2}"),
-                    ("coordinate_1_not_coordinate_2", [dict(r) for r in rows_1_not_2]),
-                    ("coordinate_2_not_coordinate_1", [dict(r) for r in rows_2_not_1]),
-                ])),
-                mimetype="application/json"
-            )
+            with eng.connect().execution_options(isolation_level="AUTOCOMMIT") as conn:
+                body = conn.execute(_Q_DISSOCIATE_COORDS, params).scalar()
+
+            return Response(body, mimetype="application/json")
 
         except Exception as e:
             return jsonify({"error": str(e)}), 500
@@ -121,6 +121,8 @@ def build_coordinates(engine: Engine, df: pd.DataFrame, schema: str, chunksize:
         print("→ coordinates: indexing & analyze")
         conn.execute(text(f"CREATE INDEX IF NOT EXISTS idx_coordinates_study ON {schema}.coordinates (study_id);"))
         conn.execute(text(f"CREATE INDEX IF NOT EXISTS idx_coordinates_geom_gist ON {schema}.coordinates USING GIST (geom);"))
+        # N-D GiST so ST_3DIntersects point lookups (which need &&&) are index-backed
+        conn.execute(text(f"CREATE INDEX IF NOT EXISTS idx_coordinates_geom_gist_nd ON {schema}.coordinates USING GIST (geom gist_geometry_ops_nd);"))
         conn.execute(text(f"ANALYZE {schema}.coordinates;"))
         conn.execute(text(f"DROP TABLE IF EXISTS {schema}.coordinates_stage;"))
     print("→ coordinates (POINTZ + GIST) done.")
@@ -170,6 +172,7 @@ def build_metadata(engine: Engine, df: pd.DataFrame, schema: str, if_exists: str
                 );
             """))
             conn.execute(text(f"ANALYZE {schema}.metadata;"))
+        conn.execute(text(f"CREATE INDEX IF NOT EXISTS idx_metadata_study ON {schema}.metadata (study_id);"))
     print("→ metadata (FTS + trigger) done.")
 
 
@@ -281,12 +284,36 @@ def build_annotations(engine: Engine, df: pd.DataFrame, schema: str, batch_cols:
             conn.execute(text(f"CREATE INDEX IF NOT EXISTS idx_annotations_json_terms_gin ON {schema}.annotations_json USING GIN (terms);"))
             conn.execute(text(f"ANALYZE {schema}.annotations_json;"))
 
+    # Index-only scans on (term, study_id) need an up-to-date visibility map,
+    # which a fresh COPY doesn't have; VACUUM can't run inside a transaction.
+    print("→ annotations_terms: vacuum analyze")
+    with engine.connect().execution_options(isolation_level="AUTOCOMMIT") as conn:
+        conn.execute(text(f"VACUUM (ANALYZE) {schema}.annotations_terms;"))
+
     print(f"→ annotations_terms total inserted: {total_inserted:,}")
     if enable_json:
         print("   … annotations_json populated and indexed.")
     print("   … annotations done.")
 
 
+# -----------------------------
+# term -> study_ids lookup (materialized view)
+# -----------------------------
+def build_term_studies(engine: Engine, schema: str):
+    print("→ term_studies: materializing term -> study_ids")
+    with engine.begin() as conn:
+        conn.execute(text(f"DROP MATERIALIZED VIEW IF EXISTS {schema}.term_studies;"))
+        conn.execute(text(f"""
+            CREATE MATERIALIZED VIEW {schema}.term_studies AS
+            SELECT term, array_agg(DISTINCT study_id) AS sids
+            FROM {schema}.annotations_terms
+            GROUP BY term;
+        """))
+        conn.execute(text(f"CREATE UNIQUE INDEX IF NOT EXISTS ux_term_studies_term ON {schema}.term_studies (term);"))
+        conn.execute(text(f"ANALYZE {schema}.term_studies;"))
+    print("→ term_studies done.")
+
+
 # -----------------------------
 # Main
 # -----------------------------
@@ -323,10 +350,14 @@ def main():
     print("\n=== Build: annotations ===")
     build_annotations(engine, ann, args.schema, args.batch_cols, enable_json=args.enable_json)
 
+    print("\n=== Build: term_studies ===")
+    build_term_studies(engine, args.schema)
+
     print("\n=== Ready ===")
     print(f"- coordinates  : {args.schema}.coordinates (geometry(POINTZ,{args.srid}) + GIST)")
     print(f"- metadata     : {args.schema}.metadata (FTS + trigger + GIN)")
     print(f"- annotations  : {args.schema}.annotations_terms (sparse via COPY)" + (" + annotations_json (GIN)" if args.enable_json else ""))
+    print(f"- term_studies : {args.schema}.term_studies (materialized term -> study_ids)")
 
 
 if __name__ == "__main__":